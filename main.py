@@ -1,4 +1,6 @@
 import os
+import io
+import re
 import asyncio
 from datetime import datetime, timezone
 from dotenv import load_dotenv
@@ -10,20 +12,21 @@ from telegram.ext import (
     ContextTypes, ConversationHandler
 )
 from telegram.constants import ParseMode
-from telegram.helpers import escape_markdown
 import logging
 from PIL import Image
+import cv2
 import pytesseract
 import google.generativeai as genai
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from aiohttp import web
 import threading
 import asyncpg
+import numpy as np
 
 # === ENV SETUP ===
 load_dotenv()
 TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "5103279067").split(",")))
+ADMIN_IDS = frozenset(map(int, os.getenv("ADMIN_IDS", "5103279067").split(",")))
 DB_URL = os.getenv("DATABASE_URL")
 
 # === GLOBAL ===
@@ -33,100 +36,220 @@ TASK_SELECT, QUESTION, ANSWER, CONFIRM_Q, CONFIRM_A = range(3, 8)
 regions = ["Tashkent", "Andijan", "Fergana", "Namangan", "Samarkand", "Bukhara",
            "Navoi", "Kashkadarya", "Surkhandarya", "Jizzakh", "Sirdarya", "Khorezm",
            "Karakalpakstan", "Other"]
+REGIONS = frozenset(regions)
 region_keyboard = [[r] for r in regions]
+TASK_RE = re.compile("^(Task 1|Task 2)$")
+PHONE_KB = ReplyKeyboardMarkup([[KeyboardButton("📞 Share Contact", request_contact=True)]], resize_keyboard=True, one_time_keyboard=True)
+REGION_KB = ReplyKeyboardMarkup(region_keyboard, resize_keyboard=True, one_time_keyboard=True)
+TASK_KB = ReplyKeyboardMarkup([["Task 1", "Task 2"]], resize_keyboard=True, one_time_keyboard=True)
+CONFIRM_A_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Yes", callback_data="confirm_a_yes"), InlineKeyboardButton("No", callback_data="confirm_a_no")]
+])
+# Same metacharacter set as telegram.helpers.escape_markdown(version=2),
+# but applied in one C-level pass instead of a regex per call.
+MD2_ESCAPE = str.maketrans({c: "\\" + c for c in r"_*[]()~`>#+-=|{}.!"})
 logging.basicConfig(level=logging.INFO)
 GEMINI_MODEL = genai.GenerativeModel("gemini-2.0-flash")
 
 # === DATABASE ===
 async def init_db():
     global DB_POOL
-    DB_POOL = await asyncpg.create_pool(DB_URL)
+    DB_POOL = await asyncpg.create_pool(DB_URL, min_size=5, max_size=20, statement_cache_size=1024)
     async with DB_POOL.acquire() as conn:
         await conn.execute('''CREATE TABLE IF NOT EXISTS users (
             user_id BIGINT PRIMARY KEY,
             full_name TEXT,
             phone_number TEXT,
             region TEXT,
-            last_submission_date TEXT,
+            last_submission_date DATE,
             task1_submitted BOOLEAN DEFAULT FALSE,
             task2_submitted BOOLEAN DEFAULT FALSE
         )''')
+        # Migrate rows created before the column was a DATE; skip once done
+        # so restarts don't retake an ACCESS EXCLUSIVE lock on users.
+        col_type = await conn.fetchval("""
+            SELECT data_type FROM information_schema.columns
+            WHERE table_name = 'users' AND column_name = 'last_submission_date'
+        """)
+        if col_type is not None and col_type != "date":
+            try:
+                await conn.execute('''ALTER TABLE users
+                    ALTER COLUMN last_submission_date TYPE DATE USING last_submission_date::date''')
+            except Exception as e:
+                logging.warning(f"last_submission_date DATE migration failed, keeping {col_type}: {e}")
+        await conn.execute("CREATE INDEX IF NOT EXISTS users_last_submission_date_idx ON users (last_submission_date)")
+        await conn.execute('''CREATE TABLE IF NOT EXISTS eval_cache (
+            id BIGSERIAL PRIMARY KEY,
+            embedding FLOAT8[],
+            result TEXT,
+            created_at TIMESTAMPTZ DEFAULT now()
+        )''')
+        rows = await conn.fetch("SELECT embedding, result FROM eval_cache ORDER BY id DESC LIMIT $1", EVAL_CACHE_SIZE)
+        for row in reversed(rows):
+            EVAL_CACHE.append((np.asarray(row["embedding"], dtype=np.float64), row["result"]))
 
-async def create_user(user_id):
-    async with DB_POOL.acquire() as conn:
-        await conn.execute("INSERT INTO users (user_id) VALUES ($1) ON CONFLICT DO NOTHING", user_id)
+# Fixed SQL strings hit asyncpg's statement cache and keep user input out
+# of query text.
+TASK_SQL = {
+    "Task 1": "UPDATE users SET task1_submitted = TRUE WHERE user_id = $1",
+    "Task 2": "UPDATE users SET task2_submitted = TRUE WHERE user_id = $1",
+}
 
-async def save_user_info(user_id, field, value):
-    async with DB_POOL.acquire() as conn:
-        await conn.execute(f"UPDATE users SET {field} = $1 WHERE user_id = $2", value, user_id)
+async def save_registration(user_id, full_name, phone_number, region):
+    await DB_POOL.execute("""
+        INSERT INTO users (user_id, full_name, phone_number, region)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (user_id) DO UPDATE
+        SET full_name = EXCLUDED.full_name,
+            phone_number = EXCLUDED.phone_number,
+            region = EXCLUDED.region
+    """, user_id, full_name, phone_number, region)
 
-async def reset_limits_if_needed(user_id):
-    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
-    async with DB_POOL.acquire() as conn:
-        row = await conn.fetchrow("SELECT last_submission_date FROM users WHERE user_id = $1", user_id)
-        if not row or not row["last_submission_date"] or today > row["last_submission_date"]:
-            await conn.execute("""
-                UPDATE users SET last_submission_date = $1,
-                                 task1_submitted = FALSE,
-                                 task2_submitted = FALSE
-                WHERE user_id = $2
-            """, today, user_id)
-
-async def get_user_status(user_id):
-    async with DB_POOL.acquire() as conn:
-        return await conn.fetchrow("SELECT last_submission_date, task1_submitted, task2_submitted FROM users WHERE user_id = $1", user_id)
+async def reset_and_get_status(user_id):
+    today = datetime.now(timezone.utc).date()
+    return await DB_POOL.fetchrow("""
+        UPDATE users
+        SET last_submission_date = $1,
+            task1_submitted = CASE WHEN last_submission_date IS NULL OR last_submission_date < $1
+                                   THEN FALSE ELSE task1_submitted END,
+            task2_submitted = CASE WHEN last_submission_date IS NULL OR last_submission_date < $1
+                                   THEN FALSE ELSE task2_submitted END
+        WHERE user_id = $2
+        RETURNING task1_submitted, task2_submitted
+    """, today, user_id)
 
 async def update_task_submission(user_id, task):
-    col = "task1_submitted" if task == "Task 1" else "task2_submitted"
-    async with DB_POOL.acquire() as conn:
-        await conn.execute(f"UPDATE users SET {col} = TRUE WHERE user_id = $1", user_id)
+    await DB_POOL.execute(TASK_SQL["Task 1"] if task == "Task 1" else TASK_SQL["Task 2"], user_id)
 
 # === OCR ===
-def extract_text_from_image(file_path):
+try:
+    from tesserocr import PyTessBaseAPI, PSM
+    TESS_API = PyTessBaseAPI(lang="eng", psm=PSM.AUTO)
+except Exception:
+    TESS_API = None
+TESS_LOCK = threading.Lock()  # the tesseract API is not thread-safe
+MAX_OCR_DIM = 2500  # ~300 dpi equivalent for a phone photo of an answer sheet
+OCR_SEMAPHORE = asyncio.Semaphore(max(1, (os.cpu_count() or 2) // 2))  # bound concurrent OCR
+
+def preprocess_image(data):
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        image = Image.open(io.BytesIO(data))
+        image.draft("L", image.size)  # grayscale-only JPEG decode
+        return image
+    scale = MAX_OCR_DIM / max(img.shape)
+    if scale < 1:
+        img = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    img = cv2.GaussianBlur(img, (3, 3), 0)
+    img = cv2.adaptiveThreshold(img, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, 31, 10)
+    return Image.fromarray(img)
+
+def extract_text_from_image(data):
     try:
-        image = Image.open(file_path)
-        text = pytesseract.image_to_string(image)
+        image = preprocess_image(data)
+        if TESS_API is not None:
+            with TESS_LOCK:
+                TESS_API.SetImage(image)
+                text = TESS_API.GetUTF8Text()
+        else:
+            text = pytesseract.image_to_string(image)
         image.close()
-        os.remove(file_path)
         return text
     except Exception:
         return None
 
+# === Semantic Cache ===
+EVAL_CACHE_SIZE = 1000
+EVAL_CACHE_THRESHOLD = 0.95
+EVAL_CACHE = []  # (unit-norm embedding, result), newest last
+
+async def embed_submission(task_type, question, answer):
+    try:
+        resp = await genai.embed_content_async(
+            model="models/text-embedding-004",
+            content=f"{task_type}\n{question}\n{answer}",
+        )
+        emb = np.asarray(resp["embedding"], dtype=np.float64)
+        return emb / np.linalg.norm(emb)
+    except Exception as e:
+        logging.warning(f"Embedding failed, skipping cache: {e}")
+        return None
+
+def cache_lookup(emb):
+    if not EVAL_CACHE:
+        return None
+    sims = np.stack([e for e, _ in EVAL_CACHE]) @ emb
+    best = int(np.argmax(sims))
+    if sims[best] > EVAL_CACHE_THRESHOLD:
+        return EVAL_CACHE[best][1]
+    return None
+
+async def cache_store(emb, result):
+    EVAL_CACHE.append((emb, result))
+    if len(EVAL_CACHE) > EVAL_CACHE_SIZE:
+        EVAL_CACHE.pop(0)
+    try:
+        await DB_POOL.execute("INSERT INTO eval_cache (embedding, result) VALUES ($1, $2)", emb.tolist(), result)
+        # Keep the table at the in-memory cap; only the newest rows are
+        # ever reloaded at startup.
+        await DB_POOL.execute("""
+            DELETE FROM eval_cache
+            WHERE id < (SELECT id FROM eval_cache ORDER BY id DESC OFFSET $1 LIMIT 1)
+        """, EVAL_CACHE_SIZE - 1)
+    except Exception as e:
+        logging.warning(f"Couldn't persist eval cache entry: {e}")
+
 # === Gemini Evaluation ===
-async def evaluate_with_gemini(task_type, question, answer, retries=3):
+CRITERIA = ["Task Achievement", "Coherence and Cohesion", "Lexical Resource", "Grammar"]
+
+async def _score_criterion(criterion, question, answer, question_image=None, retries=3):
     prompt = f"""
 You are an IELTS Academic Writing evaluator. You are responding through a Telegram bot.
-Keep your message under 4000 characters to avoid errors.
+Keep your message under 900 characters to avoid errors.
 Use Markdown formatting only where necessary and avoid long bullet lists.
 
-Question: {question if question else '[Image Attached]'}
+Question: {question if question else '[see attached image]'}
 Answer: {answer}
 
-Score and comment each:
-- Task Achievement
-- Coherence and Cohesion
-- Lexical Resource
-- Grammar
+Score and comment on this criterion only: {criterion}
 """
+    contents = [{"mime_type": "image/jpeg", "data": question_image}, prompt] if question_image else prompt
     for attempt in range(retries):
         try:
-            response = await asyncio.to_thread(GEMINI_MODEL.generate_content, prompt)
-            return response.text[:4000]
+            response = await asyncio.wait_for(GEMINI_MODEL.generate_content_async(contents), timeout=60)
+            return response.text.strip()
         except Exception as e:
-            logging.warning(f"Gemini API attempt {attempt + 1} failed: {str(e)}")
-            await asyncio.sleep(2)
-    return "\u274c Gemini API error after retries. Please try again later."
+            logging.warning(f"Gemini API attempt {attempt + 1} failed for {criterion}: {str(e)}")
+            await asyncio.sleep(2 * (attempt + 1))
+    return None
+
+async def evaluate_with_gemini(task_type, question, answer, question_image=None, retries=3):
+    # The cache key is text-only, so distinct question images would collide;
+    # skip it for image questions.
+    emb = None if question_image else await embed_submission(task_type, question, answer)
+    if emb is not None:
+        cached = cache_lookup(emb)
+        if cached:
+            return cached
+    results = await asyncio.gather(*[_score_criterion(c, question, answer, question_image, retries) for c in CRITERIA])
+    if all(r is None for r in results):
+        return "\u274c Gemini API error after retries. Please try again later."
+    parts = [r if r is not None else f"*{c}*: \u274c evaluation failed, please retry." for c, r in zip(CRITERIA, results)]
+    result = "\n\n".join(parts)[:4000]
+    if emb is not None and all(r is not None for r in results):
+        await cache_store(emb, result)
+    return result
 
 # === Health Check ===
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        self.send_response(200)
-        self.end_headers()
-        self.wfile.write(b"Bot is running")
+async def health(_request):
+    return web.Response(text="Bot is running")
 
-def run_health_server():
-    server = HTTPServer(('0.0.0.0', 8080), HealthHandler)
-    threading.Thread(target=server.serve_forever, daemon=True).start()
+async def run_health_server():
+    health_app = web.Application()
+    health_app.router.add_get("/", health)
+    runner = web.AppRunner(health_app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", 8080).start()
 
 # === Global Error Handler ===
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -146,14 +269,12 @@ WELCOME = (
 )
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await create_user(update.effective_user.id)
     await update.message.reply_text(WELCOME)
     return NAME
 
 async def get_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await save_user_info(update.effective_user.id, "full_name", update.message.text.strip())
-    kb = [[KeyboardButton("📞 Share Contact", request_contact=True)]]
-    await update.message.reply_text("📞 Please share your phone number:", reply_markup=ReplyKeyboardMarkup(kb, resize_keyboard=True, one_time_keyboard=True))
+    context.user_data["full_name"] = update.message.text.strip()
+    await update.message.reply_text("📞 Please share your phone number:", reply_markup=PHONE_KB)
     return PHONE
 
 async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -161,17 +282,18 @@ async def get_phone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(phone) < 6:
         await update.message.reply_text("⚠️ Phone number seems invalid. Please try again.")
         return PHONE
-    await save_user_info(update.effective_user.id, "phone_number", phone)
-    await update.message.reply_text("🌍 Which region are you from:", reply_markup=ReplyKeyboardMarkup(region_keyboard, resize_keyboard=True, one_time_keyboard=True))
+    context.user_data["phone_number"] = phone
+    await update.message.reply_text("🌍 Which region are you from:", reply_markup=REGION_KB)
     return REGION
 
 async def get_region(update: Update, context: ContextTypes.DEFAULT_TYPE):
     region = update.message.text.strip()
-    if region not in regions:
+    if region not in REGIONS:
         await update.message.reply_text("❌ Please choose from the list.")
         return REGION
-    await save_user_info(update.effective_user.id, "region", region)
-    await update.message.reply_text("✅ Registration complete! Choose your task:", reply_markup=ReplyKeyboardMarkup([["Task 1", "Task 2"]], resize_keyboard=True, one_time_keyboard=True))
+    await save_registration(update.effective_user.id, context.user_data.get("full_name"),
+                            context.user_data.get("phone_number"), region)
+    await update.message.reply_text("✅ Registration complete! Choose your task:", reply_markup=TASK_KB)
     return ConversationHandler.END
 
 async def choose_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -179,61 +301,68 @@ async def choose_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     task = update.message.text.strip()
     context.user_data["task"] = task
     if user_id not in ADMIN_IDS:
-        await reset_limits_if_needed(user_id)
-        stat = await get_user_status(user_id)
+        stat = await reset_and_get_status(user_id)
+        if stat is None:
+            await update.message.reply_text("❌ Please register with /start first.", reply_markup=ReplyKeyboardRemove())
+            return ConversationHandler.END
         if (task == "Task 1" and stat["task1_submitted"]) or (task == "Task 2" and stat["task2_submitted"]):
             await update.message.reply_text("❌ You have already submitted this task today. Please wait until 00:00 UTC.", reply_markup=ReplyKeyboardRemove())
             return ConversationHandler.END
     await update.message.reply_text("📷 Please send your task question (text or image):", reply_markup=ReplyKeyboardRemove())
     return QUESTION
 
-async def get_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.photo:
-        file = await update.message.photo[-1].get_file()
-        path = f"q_{update.effective_user.id}.jpg"
-        await file.download_to_drive(path)
-        context.user_data["question"] = "[Image Attached]"
-        await update.message.reply_text("✅ Question image received. Now send your answer:")
-        return ANSWER
-    else:
-        text = update.message.text.strip()
-        if not text:
-            await update.message.reply_text("❌ Could not read the question. Please try again.")
-            return QUESTION
-        context.user_data["question"] = text
-        await update.message.reply_text("✅ Question received. Now send your answer:")
-        return ANSWER
+async def get_question_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    file = await update.message.photo[-1].get_file()
+    context.user_data["question"] = "[Image Attached]"
+    context.user_data["question_image"] = bytes(await file.download_as_bytearray())
+    await update.message.reply_text("✅ Question image received. Now send your answer:")
+    return ANSWER
 
-async def get_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.photo:
-        file = await update.message.photo[-1].get_file()
-        path = f"a_{update.effective_user.id}.jpg"
-        await file.download_to_drive(path)
-        text = await asyncio.to_thread(extract_text_from_image, path)
-    else:
-        text = update.message.text.strip()
+async def get_question_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = update.message.text.strip()
+    if not text:
+        await update.message.reply_text("❌ Could not read the question. Please try again.")
+        return QUESTION
+    context.user_data["question"] = text
+    context.user_data["question_image"] = None
+    await update.message.reply_text("✅ Question received. Now send your answer:")
+    return ANSWER
+
+async def confirm_answer_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text):
     if not text:
         await update.message.reply_text("❌ Could not read the answer. Please try again.")
         return ANSWER
     context.user_data["answer"] = text
-    await update.message.reply_text(f"✏️ Is this your answer?\n\n{text}", reply_markup=InlineKeyboardMarkup([
-        [InlineKeyboardButton("Yes", callback_data="confirm_a_yes"), InlineKeyboardButton("No", callback_data="confirm_a_no")]
-    ]))
+    await update.message.reply_text(f"✏️ Is this your answer?\n\n{text}", reply_markup=CONFIRM_A_KB)
     return CONFIRM_A
 
+async def get_answer_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    file = await update.message.photo[-1].get_file()
+    buf = bytes(await file.download_as_bytearray())
+    async with OCR_SEMAPHORE:
+        text = await asyncio.to_thread(extract_text_from_image, buf)
+    return await confirm_answer_text(update, context, text)
+
+async def get_answer_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await confirm_answer_text(update, context, update.message.text.strip())
+
 async def confirm_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     answer = context.user_data.get("answer")
     question = context.user_data.get("question")
     if query.data == "confirm_a_no":
-        await query.edit_message_text(f"❌ Please resend your answer or correct it manually:\n\n`{escape_markdown(answer, version=2)}`", parse_mode=ParseMode.MARKDOWN_V2)
+        await query.edit_message_text(f"❌ Please resend your answer or correct it manually:\n\n`{answer.translate(MD2_ESCAPE)}`", parse_mode=ParseMode.MARKDOWN_V2)
         return ANSWER
     await query.edit_message_text("⏳ Evaluating your writing...")
     task = context.user_data.get("task", "Unknown")
-    result = await evaluate_with_gemini(task, question or "", answer or "")
+    result = await evaluate_with_gemini(task, question or "", answer or "", context.user_data.get("question_image"))
+    # user_data lives for the process lifetime; drop the photo bytes and
+    # submission text now that the evaluation is done.
+    for key in ("question_image", "question", "answer"):
+        context.user_data.pop(key, None)
     await update_task_submission(update.effective_user.id, task)
-    await query.message.reply_text(f"🎓 *Evaluation Result:*\n\n{escape_markdown(result, version=2)}", parse_mode=ParseMode.MARKDOWN_V2)
+    await query.message.reply_text(f"🎓 *Evaluation Result:*\n\n{result.translate(MD2_ESCAPE)}", parse_mode=ParseMode.MARKDOWN_V2)
     return ConversationHandler.END
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -241,9 +370,21 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 # === Entrypoint ===
+async def warm_gemini():
+    # Pay the TLS/channel-setup tax at startup instead of on the first
+    # user-visible evaluation after a deploy.
+    try:
+        await GEMINI_MODEL.generate_content_async("ping")
+    except Exception as e:
+        logging.warning(f"Gemini warm-up failed: {e}")
+
+async def post_init(app):
+    await init_db()
+    await run_health_server()
+    asyncio.create_task(warm_gemini())
+
 def main():
-    run_health_server()
-    app = ApplicationBuilder().token(TOKEN).post_init(lambda app: init_db()).build()
+    app = ApplicationBuilder().token(TOKEN).post_init(post_init).build()
     reg = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={
@@ -254,10 +395,12 @@ def main():
         fallbacks=[CommandHandler("cancel", cancel)],
     )
     task = ConversationHandler(
-        entry_points=[MessageHandler(filters.Regex("^(Task 1|Task 2)$"), choose_task)],
+        entry_points=[MessageHandler(filters.Regex(TASK_RE), choose_task)],
         states={
-            QUESTION: [MessageHandler(filters.TEXT | filters.PHOTO, get_question)],
-            ANSWER: [MessageHandler(filters.TEXT | filters.PHOTO, get_answer)],
+            QUESTION: [MessageHandler(filters.PHOTO, get_question_photo),
+                       MessageHandler(filters.TEXT, get_question_text)],
+            ANSWER: [MessageHandler(filters.PHOTO, get_answer_photo),
+                     MessageHandler(filters.TEXT, get_answer_text)],
             CONFIRM_A: [CallbackQueryHandler(confirm_answer, pattern="^confirm_a_.*")],
         },
         fallbacks=[CommandHandler("cancel", cancel)]